@@ -1,49 +1,40 @@
 ﻿# server.py — Mete o Shape (WhatsApp) + health-check + Q&A (OpenAI)
 # Fluxo: Boas-vindas → Q0 Nome → Anamnese → Resultados Iniciais → Plano Alimentar (cardápio exemplo)
 #        → Hidratação → Treino ABC → Mensagens diárias automáticas → Check-in semanal → Q&A livre
-import os, json, logging, threading, math, time
+import os, re, json, logging, threading, time, unicodedata
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Optional, Dict, Any, Tuple, List
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, Tuple, List, Callable, Iterable, Sequence
+from xml.sax.saxutils import escape as _xe
 from flask import Flask, request, Response
 
 # === Limite de caracteres por mensagem (WhatsApp/Twilio) ===
 WHATSAPP_CHAR_LIMIT = int(os.getenv("WA_CHAR_LIMIT", "1500"))  # margem de segurança < 1600
 
-# Twilio TwiML (fallback local) + envio opcional (REST)
+# Twilio: resposta TwiML montada à mão + envio opcional (REST)
 TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID", "")
 TWILIO_AUTH_TOKEN  = os.getenv("TWILIO_AUTH_TOKEN", "")
 TWILIO_FROM        = os.getenv("WHATSAPP_FROM", "")  # ex: 'whatsapp:+14155238886'
-
-try:
-    from twilio.twiml.messaging_response import MessagingResponse
-    from twilio.rest import Client as TwilioClient
-except Exception:  # pragma: no cover
-    class _FakeMsg:
-        def __init__(self, body: str): self.body = body
-    class MessagingResponse:  # type: ignore
-        def __init__(self): self._msgs = []
-        def message(self, text: str):
-            m = _FakeMsg(text); self._msgs.append(m); return m
-        def __str__(self):
-            # Fallback: devolve só a última mensagem (ambiente local)
-            return self._msgs[-1].body if self._msgs else ""
-    TwilioClient = None
+# SDKs (twilio.rest, openai) são importados no primeiro uso: o boot/health-check não paga esse custo
 
 # ===== OpenAI (Q&A) =====
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL   = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
-try:
-    from openai import OpenAI
-except Exception:
-    OpenAI = None  # pragma: no cover
+
+# cliente reaproveitado entre chamadas (mantém o pool HTTP/keep-alive do SDK)
+_OPENAI_CLIENT = None
 
 def _ai_client():
-    if OpenAI and OPENAI_API_KEY:
+    global _OPENAI_CLIENT
+    if _OPENAI_CLIENT is None and OPENAI_API_KEY:
         try:
-            return OpenAI(api_key=OPENAI_API_KEY)
+            from openai import OpenAI
+            _OPENAI_CLIENT = OpenAI(api_key=OPENAI_API_KEY)
         except Exception:
             return None
-    return None
+    return _OPENAI_CLIENT
 
 def _compose_profile_context(data: Dict[str, Any]) -> str:
     nome  = data.get("nome", "")
@@ -67,8 +58,8 @@ def _compose_profile_context(data: Dict[str, Any]) -> str:
         if robs: partes.append(f"Restrições: {restr} ({robs})")
         else: partes.append(f"Restrições: {restr}")
     if treino_h is not None: partes.append(f"Treino ~ {treino_h}h")
-    if fw: partes.append(f"Janela de alimentação: {fw}")
-    if mute not in (None, []): partes.append(f"Silêncio: {mute}")
+    if fw not in (None, []): partes.append(f"Janela de alimentação: {_unpack_hh(fw)}")
+    if mute not in (None, []): partes.append(f"Silêncio: {_unpack_hh(mute)}")
     return " | ".join(partes) if partes else "Sem perfil completo ainda."
 
 def _ai_answer(question: str, data: Dict[str, Any]) -> Optional[str]:
@@ -103,15 +94,15 @@ def _ai_answer(question: str, data: Dict[str, Any]) -> Optional[str]:
     except Exception:
         return None
 
+# gatilhos de Q&A no início da mensagem (duvida/dúvida/ajuda/pergunta)
+_AI_TRIGGER_RE = re.compile(r"(?:d[uú]vida|ajuda|pergunta)")
+
 def _maybe_route_to_ai(text: str, step: int) -> bool:
     """Quando true, tratamos a mensagem como Q&A instead of fluxo."""
-    t = (text or "").strip().lower()
     if step >= 999:
         return True
-    if "?" in t:
-        return True
-    gatilhos = ("duvida","dúvida","ajuda","pergunta")
-    return any(t.startswith(g) for g in gatilhos)
+    t = (text or "").strip().lower()
+    return "?" in t or _AI_TRIGGER_RE.match(t) is not None
 
 APP_NAME = os.getenv("PROJECT_NAME", "mete_o_shape")
 # >>> Ajuste de fuso horário dos lembretes <<<
@@ -138,48 +129,156 @@ def _save_db_local(db: Dict[str, Any]) -> None:
     tmp = DB_PATH + ".tmp"
     with _lock:
         with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(db, f, ensure_ascii=False, indent=2)
+            json.dump(db, f, ensure_ascii=False, separators=(",", ":"))
+            # conteúdo no disco antes do rename: uma queda nunca deixa db.json pela metade
+            f.flush()
+            os.fsync(f.fileno())
         os.replace(tmp, DB_PATH)
 
-# tenta usar storage.py do projeto; se não existir, usa local
+# tenta usar storage.py do projeto (SQLite); se não existir, usa o db.json local com as mesmas assinaturas
+# load_user*/save_user: UM usuário (caminho do /bot) | load_users/save_users: lotes do cron
 try:
-    from storage import load_db as _load_ext, save_db as _save_ext  # type: ignore
-    def load_db() -> Dict[str, Any]: return _load_ext()
-    def save_db(db: Dict[str, Any]) -> None: _save_ext(db)
+    from storage import (  # type: ignore
+        load_user, load_user_seen, dump_state, save_user, touch_user,
+        load_users, save_users,
+        set_fire_slots, uids_for_hour, uids_checkin_due, mark_checkin_sent, uids_without_slots,
+        prune_stale_users,
+    )
 except Exception:  # pragma: no cover
-    def load_db() -> Dict[str, Any]: return _load_db_local()
-    def save_db(db: Dict[str, Any]) -> None: _save_db_local(db)
+    def _users_local() -> Dict[str, Dict[str, Any]]:
+        return _load_db_local().get("users", {})
+
+    def load_user(uid: str) -> Optional[Dict[str, Any]]:
+        return _users_local().get(uid)
+
+    def load_user_seen(uid: str) -> Tuple[Optional[Dict[str, Any]], int]:
+        return load_user(uid), 0
+
+    def dump_state(st: Dict[str, Any]) -> str:
+        return json.dumps(st, ensure_ascii=False, separators=(",", ":"))
+
+    def save_user(uid: str, st: Dict[str, Any], raw: Optional[str] = None) -> None:
+        db = _load_db_local()
+        db.setdefault("users", {})[uid] = st
+        _save_db_local(db)
+
+    def touch_user(uid: str, min_age_s: int = 3600) -> None:
+        pass  # sem updated_at local (e sem limpeza: prune_stale_users abaixo)
+
+    def load_users(uids: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+        users = _users_local()
+        return {uid: users[uid] for uid in uids if uid in users}
+
+    def save_users(items: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+        db = _load_db_local()
+        db.setdefault("users", {}).update(items)
+        _save_db_local(db)
+
+    # sem índice local: o cron confere todos os usuários (o filtro por hora fica no payload)
+    def set_fire_slots(uid: str, slots: Iterable[Sequence[Any]]) -> None:
+        pass
+
+    def uids_for_hour(hour: int) -> List[str]:
+        return list(_users_local())
+
+    def uids_checkin_due(day: str) -> List[str]:
+        # só planos concluídos (no índice real só eles têm a linha de check-in); a data fica em last
+        return [uid for uid, u in _users_local().items()
+                if int(u.get("step", 0)) >= 999 and "slots" in (u.get("schedule") or {})]
+
+    def mark_checkin_sent(uids: Iterable[str], day: str) -> None:
+        pass
+
+    def uids_without_slots() -> List[str]:
+        return [uid for uid, u in _users_local().items()
+                if int(u.get("step", 0)) >= 999 and "slots" not in (u.get("schedule") or {})]
+
+    def prune_stale_users(max_idle_s: int) -> int:
+        return 0
+
+# Locks por uid (listrados): mensagens do MESMO usuário serializam o ciclo
+# ler → alterar → gravar; usuários diferentes seguem em paralelo.
+_UID_LOCKS = [threading.Lock() for _ in range(256)]
+
+def _uid_lock(uid: str) -> threading.Lock:
+    return _UID_LOCKS[hash(uid) & 255]
+
+@contextmanager
+def _try_uid_locks(uids):
+    """Trava, SEM esperar, as listras dos uids (lote do cron) e devolve os uids travados.
+    Listra ocupada (ex.: /bot aguardando a IA) => o uid fica para o próximo tick;
+    o cron nunca segura listras enquanto espera outra (sem comboio de webhooks)."""
+    held: Dict[threading.Lock, bool] = {}
+    got = []
+    try:
+        for uid in uids:
+            lock = _uid_lock(uid)
+            if lock not in held:
+                held[lock] = lock.acquire(blocking=False)
+            if held[lock]:
+                got.append(uid)
+        yield got
+    finally:
+        for lock, ok in held.items():
+            if ok:
+                lock.release()
+
+def _new_user_state() -> Dict[str, Any]:
+    return {"flow": "ms", "step": 0, "data": {}, "schedule": {"last": {}}}
 
 # ===================== Helpers / Constantes =====================
-START_WORDS = {"oi", "ola", "olá", "bom dia", "boa tarde", "boa noite", "iniciar"}
+# comandos/saudações são comparados já sem acento (_fold): só a grafia ASCII precisa constar
+START_WORDS = frozenset({"oi", "ola", "bom dia", "boa tarde", "boa noite", "iniciar"})
+
+def _fold(s: str) -> str:
+    """Chave sem acento para comparar comandos ('olá' → 'ola', 'recomeçar' → 'recomecar')."""
+    if s.isascii():
+        return s
+    return unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("ascii")
+
+_NON_DIGITS_RE = re.compile(r"\D+")
 
 def _digits_only(s: Optional[str]) -> str:
-    return "".join(ch for ch in (s or "") if ch.isdigit())
+    return _NON_DIGITS_RE.sub("", s or "")
 
 def _uid_from(sender: str, waid: Optional[str]) -> str:
-    d = _digits_only(waid or "") or _digits_only(sender or "")
+    # WaId já vem só com dígitos na prática; sender só é varrido se WaId faltar
+    d = _digits_only(waid) or _digits_only(sender)
     return d or (sender or "anon")
 
 def _safe_reply(text: Optional[str]) -> str:
     t = (text or "").strip()
     return t if t else "⚠️ Não entendi. Digite **oi** para iniciar ou **reiniciar** para recomeçar."
 
+# round() sem casas já devolve int (arredondamento bancário, como antes)
 def _round(x: float, base: int = 5) -> int:
-    return int(base * round(float(x) / base))
+    return base * round(x / base)
 
 def _round_g(x: float) -> int:
-    return int(round(x))
+    return round(x)
+
+# tzinfo resolvido uma vez; None (TZ inválido/sem zoneinfo) => hora local do servidor
+try:
+    from zoneinfo import ZoneInfo  # py3.9+
+    _TZINFO = ZoneInfo(TZ)
+except Exception:
+    _TZINFO = None
 
 def _now_br() -> datetime:
-    try:
-        from zoneinfo import ZoneInfo  # py3.9+
-        return datetime.now(ZoneInfo(TZ))
-    except Exception:
-        return datetime.now()
+    return datetime.now(_TZINFO)
 
 def _clamp_hour(h: int) -> int:
     return max(0, min(23, int(h)))
 
+def _norm_hour(v: Any) -> Optional[int]:
+    """Hora salva no perfil → int 0–23 ou None (perfis antigos podem ter str/float)."""
+    if v is None or v == "":
+        return None
+    try:
+        return _clamp_hour(int(v))
+    except (TypeError, ValueError):
+        return None
+
 def _parse_hh_range(s: str) -> Optional[Tuple[int,int]]:
     """'HH–HH' ou 'HH-HH' → (start,end) horas [0..23]"""
     s = (s or "").replace(" ", "").replace("—","-").replace("–","-")
@@ -191,6 +290,18 @@ def _parse_hh_range(s: str) -> Optional[Tuple[int,int]]:
     except Exception:
         return None
 
+def _pack_hh(A: int, B: int) -> int:
+    """(HH, HH) → inteiro único A*256+B (formato salvo em feeding_window/mute_hours)."""
+    return A * 256 + B
+
+def _unpack_hh(v: Any) -> Optional[Tuple[int,int]]:
+    """Inverso de _pack_hh; aceita também o formato legado [A, B]. None/[] → None."""
+    if v is None or v == []:
+        return None
+    if isinstance(v, int):
+        return divmod(v, 256)
+    return (_clamp_hour(v[0]), _clamp_hour(v[1]))
+
 def _in_window(hour: int, A: int, B: int) -> bool:
     """Retorna True se 'hour' está dentro da janela [A..B] inclusive, considerando A<=B."""
     if A <= B:
@@ -207,6 +318,8 @@ def _in_mute(hour: int, M: int, N: int) -> bool:
         return hour >= M or hour < N
 
 # --------- Split seguro para WhatsApp ---------
+_SPLIT_SEPS = ("\n\n", "\n", " ")
+
 def _split_for_whatsapp(text: str, limit: int = WHATSAPP_CHAR_LIMIT) -> List[str]:
     """Divide 'text' em pedaços <= limit, preferindo quebras limpas."""
     if not text:
@@ -215,37 +328,33 @@ def _split_for_whatsapp(text: str, limit: int = WHATSAPP_CHAR_LIMIT) -> List[str
     if len(text) <= limit:
         return [text]
 
+    # varredura por índices: sem recopiar o restante do texto a cada corte
     parts: List[str] = []
-    rest = text
-    seps = ["\n\n", "\n", " "]
-
-    while len(rest) > limit:
+    i, n = 0, len(text)
+    while n - i > limit:
         cut = -1
         # tenta cada separador do mais forte pro mais fraco
-        for sep in seps:
-            pos = rest.rfind(sep, 0, limit)
+        for sep in _SPLIT_SEPS:
+            pos = text.rfind(sep, i, i + limit)
             if pos > cut:
                 cut = pos
-        if cut <= 0:
-            cut = limit  # sem separador útil, corta seco
+        if cut <= i:
+            cut = i + limit  # sem separador útil, corta seco
 
-        chunk = rest[:cut].rstrip()
-        parts.append(chunk)
-        rest = rest[cut:].lstrip()
+        parts.append(text[i:cut].rstrip())
+        i = cut
+        while i < n and text[i].isspace():
+            i += 1
 
-    if rest:
-        parts.append(rest)
+    if i < n:
+        parts.append(text[i:])
     return parts
 
-# (Mantidos, ainda que não usados após retirar Q2 faixa)
-AGE_MAP = {
-    "1": (16, 24, 21),
-    "2": (25, 34, 29),
-    "3": (35, 44, 39),
-    "4": (45, 54, 49),
-    "5": (55, 64, 59),
-    "6": (65, 75, 68),
-}
+def _twiml(chunks: List[str]) -> str:
+    """TwiML de resposta (mesmo XML que o MessagingResponse gera), uma <Message> por parte."""
+    body_xml = "".join(f"<Message>{_xe(c)}</Message>" for c in chunks)
+    return f'<?xml version="1.0" encoding="UTF-8"?><Response>{body_xml}</Response>'
+
 HEIGHT_MAP = {  # cm (low, high, mid)
     "1": (150, 159, 158),
     "2": (160, 169, 165),
@@ -262,6 +371,10 @@ WEIGHT_MAP = {  # kg (low, high, mid)
     "6": (100, 130, 105.0),
 }
 
+# opção → (faixa para o perfil, estimativa) — rótulos montados uma vez no import
+HEIGHT_CHOICES = {k: (f"{lo}–{hi} cm" if hi != 205 else "≥190 cm", mid) for k, (lo, hi, mid) in HEIGHT_MAP.items()}
+WEIGHT_CHOICES = {k: (f"{lo}–{hi} kg" if hi != 130 else "100+ kg", mid) for k, (lo, hi, mid) in WEIGHT_MAP.items()}
+
 ACTIVITY_FACTOR = {
     "Sedentário": 1.25,
     "Leve":       1.40,
@@ -275,15 +388,63 @@ OBJ_CAL_ADJ = {
     "Hipertrofia":    0.10,
 }
 
+# Proteína: 2.0 g/kg (com guard entre 1.6 e 2.4) | Gorduras: 25% das kcal
+PROT_G_PER_KG = max(1.6, min(2.4, 2.0))
+GORD_KCAL_PCT = 0.25
+
+# Hidratação: 37 ml/kg (mín. 2 L), dividida por período do dia
+AGUA_ML_POR_KG = 37
+AGUA_SPLIT_PCT = (("manhã", 0.33), ("tarde", 0.37), ("noite", 0.30))
+
 # ============== Envio opcional de mensagens proativas (cron) ==============
+# Pool de envio: pedaços para o MESMO destino seguem em ordem (uma tarefa por destino);
+# o paralelismo é entre destinos diferentes (varredura do cron).
+TWILIO_SEND_WORKERS = int(os.getenv("TWILIO_SEND_WORKERS", "16"))
+_TWILIO_POOL = ThreadPoolExecutor(max_workers=TWILIO_SEND_WORKERS, thread_name_prefix="twilio-send")
+# Teto global de envios REST (msgs/s, somando todas as threads). 0 desliga.
+TWILIO_MAX_MPS = float(os.getenv("TWILIO_MAX_MPS", "50"))
+_rate_lock = threading.Lock()
+_rate_next = 0.0
+
+def _rate_wait() -> None:
+    """Espaça as chamadas em 1/TWILIO_MAX_MPS s: cada uma reserva o próximo horário livre."""
+    global _rate_next
+    if TWILIO_MAX_MPS <= 0:
+        return
+    with _rate_lock:
+        now = time.monotonic()
+        slot = max(now, _rate_next)
+        _rate_next = slot + 1.0 / TWILIO_MAX_MPS
+    if slot > now:
+        time.sleep(slot - now)
+
+_TWILIO_CLIENT = None
+
+def _twilio_http_client():
+    """Sessão keep-alive com pool do tamanho do _TWILIO_POOL; reenvia só 429 e falha de conexão
+    (5xx/timeout de leitura num POST podem já ter enviado a mensagem)."""
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    from twilio.http.http_client import TwilioHttpClient
+    http = TwilioHttpClient(pool_connections=True)
+    retry = Retry(total=2, connect=2, read=0, status=2, status_forcelist=(429,),
+                  allowed_methods=None, backoff_factor=0.3, raise_on_status=False)
+    http.session.mount("https://", HTTPAdapter(pool_maxsize=TWILIO_SEND_WORKERS, max_retries=retry))
+    return http
 
 def _twilio_client():
-    if TwilioClient and TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_FROM:
+    global _TWILIO_CLIENT
+    if _TWILIO_CLIENT is None and TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_FROM:
+        try:
+            http = _twilio_http_client()
+        except Exception:
+            http = None  # cliente HTTP padrão do SDK
         try:
-            return TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+            from twilio.rest import Client as TwilioClient
+            _TWILIO_CLIENT = TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=http)
         except Exception:
             return None
-    return None
+    return _TWILIO_CLIENT
 
 def _send_whatsapp(to_num: str, body: str, log) -> bool:
     """Envia com split automático em múltiplas mensagens se necessário."""
@@ -302,6 +463,7 @@ def _send_whatsapp(to_num: str, body: str, log) -> bool:
     ok = True
     for idx, ch in enumerate(chunks, 1):
         try:
+            _rate_wait()
             cli.messages.create(from_=TWILIO_FROM, to=to_num, body=ch)
             log.info(f"[send] OK to={to_num} part={idx}/{len(chunks)} len={len(ch)}")
         except Exception as e:
@@ -309,43 +471,36 @@ def _send_whatsapp(to_num: str, body: str, log) -> bool:
             ok = False
     return ok
 
+def _send_many(payloads: List[Tuple[str, str]], log) -> None:
+    """Envia em sequência uma lista de (to, body) — roda como uma tarefa do pool."""
+    for to, body in payloads:
+        _send_whatsapp(to, body, log)
+
 # ===================== Cálculos de Nutrição =====================
 
-def _calc_tmb_mifflin(sexo: str, peso_kg: float, altura_cm: float, idade: int) -> float:
-    base = 10 * peso_kg + 6.25 * altura_cm - 5 * idade
-    return base + (5 if (sexo or "").lower().startswith("m") else -161)
-
-def _calc_get(tmb: float, atividade: str) -> float:
-    f = ACTIVITY_FACTOR.get(atividade, 1.40)
-    return tmb * f
-
-def _apply_objective(cal_get: float, objetivo: str) -> float:
-    adj = OBJ_CAL_ADJ.get(objetivo, 0.0)
-    return cal_get * (1.0 + adj)
-
-def _calc_macros(peso_kg: float, cal_alvo: float) -> Tuple[int, int, int]:
-    # Proteína: 2.0 g/kg (com guard entre 1.6 e 2.4)
-    prot_g  = max(1.6, min(2.4, 2.0)) * peso_kg
-    # Gorduras: 25% (9 kcal/g)
-    gord_kcal = cal_alvo * 0.25
-    gord_g = gord_kcal / 9.0
-    # Carboidratos: resto (4 kcal/g)
-    cal_rest = cal_alvo - (prot_g * 4.0) - gord_kcal
-    carb_g = max(0.0, cal_rest / 4.0)
-    return _round_g(prot_g), _round_g(carb_g), _round_g(gord_g)
+# entradas discretas (faixas de altura/peso, idade inteira, 4 atividades × 3 objetivos): perfis se repetem
+@lru_cache(maxsize=4096)
+def _calc_plan(sexo: str, peso_kg: float, altura_cm: float, idade: int,
+               atividade: str, objetivo: str) -> Tuple[int, int, int, int, int, int]:
+    """TMB (Mifflin) → TDEE → calorias meta → macros numa passada só.
+    Retorna (tmb, tdee, calorias, prot_g, carb_g, gord_g), já arredondados."""
+    tmb = 10 * peso_kg + 6.25 * altura_cm - 5 * idade + (5 if (sexo or "").lower().startswith("m") else -161)
+    tdee = tmb * ACTIVITY_FACTOR.get(atividade, 1.40)
+    cal = max(1200, _round(tdee * (1.0 + OBJ_CAL_ADJ.get(objetivo, 0.0)), base=10))
+    prot_g = PROT_G_PER_KG * peso_kg
+    # Gorduras (9 kcal/g) | Carboidratos: resto (4 kcal/g)
+    gord_kcal = cal * GORD_KCAL_PCT
+    carb_g = max(0.0, (cal - prot_g * 4.0 - gord_kcal) / 4.0)
+    return (round(tmb), round(tdee), cal,
+            _round_g(prot_g), _round_g(carb_g), _round_g(gord_kcal / 9.0))
 
 def _split_by_meals(total: int, meals: int) -> Dict[str, int]:
-    base = total / meals
-    parts = [int(round(base)) for _ in range(meals)]
-    diff = total - sum(parts)
-    i = 0
-    while diff != 0:
-        if diff > 0:
-            parts[i] += 1; diff -= 1
-        else:
-            if parts[i] > 0:
-                parts[i] -= 1; diff += 1
-        i = (i + 1) % meals
+    # só inteiros: mesmo resultado de partir de round(total/meals) e corrigir a sobra a partir da Ref 1
+    q, r = divmod(total, meals)
+    if 2 * r > meals or (2 * r == meals and q % 2):
+        parts = [q] * (meals - r) + [q + 1] * r
+    else:
+        parts = [q + 1] * r + [q] * (meals - r)
     return {f"Ref {i+1}": v for i, v in enumerate(parts)}
 
 # ===================== Cardápio exemplo =====================
@@ -398,6 +553,17 @@ def _render_cardapio() -> str:
             linhas.append(f"• {bloco}: " + " | ".join(itens))
     return "\n".join(linhas)
 
+# cardápio e treino são fixos: montados uma vez no import
+CARDAPIO_TXT = _render_cardapio()
+
+TREINO_TXT = (
+    "🏋️ *Treino (ABC sugerido)*\n"
+    "A: Peito, Ombro, Tríceps\n"
+    "B: Costas, Bíceps\n"
+    "C: Pernas, Abdômen\n"
+    "Frequência: 3x/sem (ABC) ou 6x/sem (ABC duas vezes)\n"
+)
+
 # ===================== Core do fluxo =====================
 # --- MODO TESTE 3m (ativável por senha via WhatsApp) ---
 TEST_SECRET = "#ativar3m"
@@ -414,19 +580,423 @@ def _normalize_e164(s: Optional[str]) -> str:
         s = s.split(":", 1)[1]
     return s
 
+# --- Perguntas do cadastro (Q0–Q7) ---
+WELCOME_TEXT = (
+    "👋 *Bem-vindo ao Mete o Shape* 🚀\n"
+    "Aqui você terá acompanhamento completo de nutrição, treino e motivação.\n"
+    "Vamos começar rápido.\n\n"
+    "**Q0. Qual seu primeiro nome?**"
+)
+Q1_TEXT = (
+    "**Q1. Sexo**\n"
+    "a) Masculino\nb) Feminino\n_Responda a–b._"
+)
+Q2B_TEXT = "**Q2b. Qual sua idade EXATA (número)?**"
+Q3_TEXT = (
+    "**Q3. Altura (faixa)**\n"
+    "a) <1,60 m\nb) 1,60–1,69 m\nc) 1,70–1,79 m\nd) 1,80–1,89 m\ne) ≥1,90 m\n_Responda a–e._"
+)
+Q4_TEXT = (
+    "**Q4. Peso atual (faixa, kg)**\n"
+    "a) <60\nb) 60–69\nc) 70–79\nd) 80–89\ne) 90–99\nf) 100+\n_Responda a–f._"
+)
+Q5_TEXT = (
+    "**Q5. Nível de atividade física**\n"
+    "a) Sedentário (0–1x/sem)\nb) Leve (2–3x/sem)\nc) Moderado (3–4x/sem)\nd) Intenso (5–6x/sem)\n_Responda a–d._"
+)
+Q6_TEXT = (
+    "**Q6. Objetivo principal**\n"
+    "a) Emagrecimento\nb) Definição/Manutenção\nc) Ganho de massa\n_Responda a–c._"
+)
+Q7_TEXT = (
+    "**Q7. Restrições/observações**\n"
+    "a) Sem restrições\nb) Intolerância à lactose\nc) Vegetariano\nd) Low-carb\ne) Outras\n_Responda a–e._"
+)
+Q7_OBS_TEXT = "✍️ Digite sua observação em uma frase curta (ex.: alergia a ovos)."
+
+# --- Perguntas do perfil de alertas (Q8a/Q8b/Q8c) ---
+Q8A_TEXT = (
+    "**Q8a. Horário do TREINO**\n"
+    "a) 6h  b) 12h  c) 17h  d) 18h  e) 19h  f) 20h  g) Não treino  h) Outro (0–23)\n"
+    "_Responda a–h._"
+)
+Q8B_TEXT = (
+    "**Q8b. Janela de ALIMENTAÇÃO (HH–HH)**\n"
+    "a) 08–20  b) 07–21  c) 06–22  d) 10–18  e) Outra (digite HH–HH)\n"
+    "_Responda a–e._"
+)
+Q8C_TEXT = (
+    "**Q8c. Silêncio/Não perturbe (HH–HH)**\n"
+    "a) 22–05  b) 23–06  c) 00–06  d) Não silenciar  e) Outra (HH–HH)\n"
+    "_Responda a–e._"
+)
+
+# Respostas fixas (iguais para todo usuário)
+MSG_ONLINE = "✅ Online. Digite **oi** para iniciar."
+MSG_RESET = "🔁 Reiniciado. Digite **oi** para começar."
+MSG_IN_FLOW = "ℹ️ Estamos no processo. Para recomeçar: **reiniciar**."
+MSG_PAUSED = "⏸️ Lembretes pausados. Envie *ATIVAR* para reativar."
+MSG_RESUMED = "▶️ Lembretes reativados. Você receberá mensagens ao longo do dia."
+MSG_DONE = (
+    "✅ Fluxo concluído.\n"
+    "• *reiniciar* para recomeçar\n"
+    "• *pausar* ou *ativar* lembretes\n"
+    "• Pode me perguntar dúvidas de treino/nutrição 👍"
+)
+MSG_FALLBACK = "❓ Não entendi. Digite **oi** para iniciar ou **reiniciar** para recomeçar."
+MSG_ERROR = "⚠️ Tive um erro aqui. Mande **reiniciar** ou **oi** para seguir."
+
+# ---- Step 0 → Q0 (saudação + NOME)
+def _step_0(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    if _fold(text) not in START_WORDS:
+        if _maybe_route_to_ai(text, 0):
+            ai = _ai_answer(body, data)
+            if ai:
+                return ai + "\n\nPara começar o plano, digite **oi**."
+        return "👋 Digite **oi** para iniciar."
+    st["step"] = 1; st["data"] = {}
+    return WELCOME_TEXT
+
+# ===================== Q0 Nome =====================
+def _step_1(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    nome = (body or "").strip()
+    if not nome or len(nome) < 2:
+        return "❗ Me diga seu primeiro nome (ex.: Carlos)."
+    data["nome"] = nome.split()[0].title()
+    st["step"] = 2
+    return Q1_TEXT
+
+# ===================== ANAMNESE =====================
+# opção (já normalizada a→1, b→2, ...) → valor gravado no perfil; montadas uma vez no import
+SEXO_CHOICES = {"1": "Masculino", "2": "Feminino"}
+ATIVIDADE_CHOICES = {"1": "Sedentário", "2": "Leve", "3": "Moderado", "4": "Intenso"}
+OBJETIVO_CHOICES = {"1": "Emagrecimento", "2": "Manutenção", "3": "Hipertrofia"}
+RESTR_CHOICES = {
+    "1": "Sem restrições",
+    "2": "Sem lactose",
+    "3": "Vegetariano",
+    "4": "Low-carb",
+    "5": "Outras",
+}
+TRAINING_HOUR_CHOICES = {"1": 6, "2": 12, "3": 17, "4": 18, "5": 19, "6": 20}
+FEEDING_WINDOW_CHOICES = {k: _pack_hh(a, b) for k, (a, b) in {"1": (8, 20), "2": (7, 21), "3": (6, 22), "4": (10, 18)}.items()}
+MUTE_CHOICES = {k: _pack_hh(a, b) for k, (a, b) in {"1": (22, 5), "2": (23, 6), "3": (0, 6)}.items()}
+MEALS_CHOICES = {"1": 3, "2": 4, "3": 5, "4": 6}
+
+# Q1 (Sexo) → **pede idade EXATA (sem faixa)**
+def _step_2(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    sexo = SEXO_CHOICES.get(text)
+    if sexo is None:
+        return "❗ Responda **1** (Masculino) ou **2** (Feminino)."
+    data["sexo"] = sexo
+    st["step"] = 4
+    return Q2B_TEXT
+
+# Q2b (idade exata) → Q3 (altura)
+def _step_4(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    digits = _digits_only(body)
+    idade_exata = int(digits) if digits else 0
+    if 10 < idade_exata < 100:
+        data["idade_exata"] = idade_exata
+    else:
+        data["idade_exata"] = data.get("idade_estimada", 30)
+    st["step"] = 5
+    return Q3_TEXT
+
+# Q3 Altura → Q4 Peso
+def _step_5(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    choice = HEIGHT_CHOICES.get(text)
+    if choice is None:
+        return "❗ Altura: responda **1–5**."
+    data["altura_faixa"], data["altura_cm_est"] = choice
+    st["step"] = 6
+    return Q4_TEXT
+
+# Q4 Peso → Q5 Atividade
+def _step_6(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    choice = WEIGHT_CHOICES.get(text)
+    if choice is None:
+        return "❗ Peso: responda **1–6**."
+    data["peso_faixa"], data["peso_kg_est"] = choice
+    st["step"] = 7
+    return Q5_TEXT
+
+# Q5 Atividade → Q6 Objetivo
+def _step_7(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    atividade = ATIVIDADE_CHOICES.get(text)
+    if atividade is None:
+        return "❗ Atividade: responda **1–4**."
+    data["atividade"] = atividade
+    st["step"] = 8
+    return Q6_TEXT
+
+# Q6 Objetivo → Q7 Restrições
+def _step_8(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    objetivo = OBJETIVO_CHOICES.get(text)
+    if objetivo is None:
+        return "❗ Objetivo: responda **1–3**."
+    data["objetivo"] = objetivo
+    st["step"] = 9
+    return Q7_TEXT
+
+# Q7 → Observação livre (71) ou segue
+def _step_9(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    restr = RESTR_CHOICES.get(text)
+    if restr is None:
+        return "❗ Responda **1–5**."
+    data["restricoes"] = restr
+    if text == "5":
+        st["step"] = 91
+        return Q7_OBS_TEXT
+    # pula fotos e vai direto para Q8a
+    st["step"] = 100
+    return Q8A_TEXT
+
+def _step_91(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    obs = (body or "").strip()
+    if not obs:
+        return "❗ Escreva uma observação curta (texto)."
+    data["restricoes_obs"] = obs
+    # pula fotos e vai direto para Q8a
+    st["step"] = 100
+    return Q8A_TEXT
+
+# ===================== Q8a/Q8b/Q8c (perfil de alertas) =====================
+def _step_100(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    opt = text
+    if opt in TRAINING_HOUR_CHOICES:
+        data["training_hour"] = TRAINING_HOUR_CHOICES[opt]
+    elif opt == "7":
+        data["training_hour"] = None
+    elif opt == "8":
+        return "Digite a hora do treino (0–23), número inteiro."
+    else:
+        try:
+            h = _clamp_hour(int(opt))
+            data["training_hour"] = h
+        except Exception:
+            return "❗ Responda 1–8 ou uma hora válida (0–23)."
+    st["step"] = 101
+    return Q8B_TEXT
+
+def _step_101(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    if text in FEEDING_WINDOW_CHOICES:
+        data["feeding_window"] = FEEDING_WINDOW_CHOICES[text]
+    else:
+        rng = _parse_hh_range(body or "")
+        if not rng:
+            return "❗ Formato inválido. Envie no formato HH–HH (ex.: 08–20)."
+        data["feeding_window"] = _pack_hh(*rng)
+    st["step"] = 102
+    return Q8C_TEXT
+
+def _step_102(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    if text == "4":
+        data["mute_hours"] = None
+    elif text in MUTE_CHOICES:
+        data["mute_hours"] = MUTE_CHOICES[text]
+    else:
+        rng = _parse_hh_range(body or "")
+        if not rng:
+            return "❗ Formato inválido. Envie HH–HH (ex.: 22–05) ou escolha 1–4."
+        data["mute_hours"] = _pack_hh(*rng)
+    st["step"] = 11
+    nome = data.get("nome","")
+    return (
+        "✅ *Resumo rápido*\n"
+        f"Nome: {nome}\n"
+        f"Sexo: {data['sexo']} | Idade: {data.get('idade_exata', data.get('idade_estimada'))} anos\n"
+        f"Altura: {data['altura_faixa']} | Peso: {data['peso_faixa']}\n"
+        f"Atividade: {data['atividade']} | Objetivo: {data['objetivo']}\n"
+        f"Restrições: {data.get('restricoes')} {('('+data.get('restricoes_obs','')+')') if data.get('restricoes_obs') else ''}\n"
+        f"Treino: {('sem treino' if data.get('training_hour') is None else str(data.get('training_hour'))+'h')}\n"
+        f"Janela: {_unpack_hh(data.get('feeding_window')) or (8, 20)}\n"
+        f"Silêncio: {_unpack_hh(data.get('mute_hours')) or 'nenhum'}\n\n"
+        "**Confirmar?**\na) Confirmar\nb) Reiniciar"
+    )
+
+# Confirmação → Resultados Iniciais
+def _step_11(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    if text == "2":
+        st["step"] = 0; st["data"] = {}
+        return MSG_RESET
+    if text != "1":
+        return "❗ Responda **1** para Confirmar ou **2** para Reiniciar."
+
+    sexo   = data.get("sexo", "Masculino")
+    idade  = int(data.get("idade_exata", data.get("idade_estimada", 30)))
+    peso   = float(data.get("peso_kg_est", 75.0))
+    altura = float(data.get("altura_cm_est", 175.0))
+    objetivo  = data.get("objetivo", "Manutenção")
+    atividade = data.get("atividade", "Leve")
+    nome      = data.get("nome","")
+
+    tmb, tdee, cal_final, prot_g, carb_g, gord_g = _calc_plan(sexo, peso, altura, idade, atividade, objetivo)
+
+    data.update({
+        "tmb": tmb,
+        "tdee": tdee,
+        "calorias": cal_final,
+        "prot_g": prot_g, "carb_g": carb_g, "gord_g": gord_g
+    })
+
+    st["step"] = 12
+    return (
+        f"📊 *Resultados Iniciais — {nome} ({idade} anos)*\n"
+        f"TMB: {data['tmb']} kcal\n"
+        f"TDEE (atividade): {data['tdee']} kcal\n"
+        f"Calorias meta ({objetivo}): {data['calorias']} kcal/dia\n"
+        f"Macros: Proteína {prot_g} g | Carboidratos {carb_g} g | Gorduras {gord_g} g\n\n"
+        "**Q9. Quantas refeições por dia você prefere?**\n"
+        "a) 3\nb) 4\nc) 5\nd) 6+\n_Responda a–d._"
+    )
+
+# Q9 — Nº de refeições → Plano + Cardápio + Hidratação + Treino
+def _step_12(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    meals = MEALS_CHOICES.get(text)
+    if meals is None:
+        return "❗ Refeições: responda **1–4**."
+    data["meal_count"] = meals
+
+    kcal_split = _split_by_meals(int(data["calorias"]), meals)
+    p_split = _split_by_meals(int(data["prot_g"]), meals)
+    c_split = _split_by_meals(int(data["carb_g"]), meals)
+    g_split = _split_by_meals(int(data["gord_g"]), meals)
+    data.update({"split_kcal": kcal_split, "split_p": p_split, "split_c": c_split, "split_g": g_split})
+
+    # Hidratação
+    peso = float(data.get("peso_kg_est", 75.0))
+    agua_ml = round(peso * AGUA_ML_POR_KG)
+    agua_l = max(2, round(agua_ml/1000, 1))
+    agua_split = {periodo: round(agua_l * pct, 1) for periodo, pct in AGUA_SPLIT_PCT}
+    data.update({"agua_l": agua_l, "agua_split": agua_split})
+
+    linhas_split = []
+    for i in range(1, meals+1):
+        k = f"Ref {i}"
+        linhas_split.append(
+            f"- {k}: {kcal_split[k]} kcal | Proteína {p_split[k]} g | Carboidratos {c_split[k]} g | Gorduras {g_split[k]} g"
+        )
+    split_txt = "\n".join(linhas_split)
+
+    agua_txt = f"💧 *Hidratação*: ~{agua_l} L/dia ({', '.join(f'{p} {v} L' for p, v in agua_split.items())})."
+    nome = data.get("nome",""); idade = int(data.get("idade_exata", data.get("idade_estimada", 30)))
+
+    st["step"] = 999
+    schedule = st.setdefault("schedule", {"last": {}})
+    schedule.setdefault("last", {})
+    schedule["enabled"] = True
+    data["training_hour"] = _norm_hour(data.get("training_hour"))
+    schedule["slots"] = _fire_slots(data)
+    set_fire_slots(uid, schedule["slots"] + [[CHECKIN_HOUR, "checkin"]])
+
+    # Texto único (será splitado na camada TwiML/REST)
+    return (
+        f"🔥 *Plano Inicial — {nome} ({idade} anos)*\n\n"
+        f"Calorias: {data['calorias']} kcal/dia\n"
+        f"Macros: Proteína {data['prot_g']} g | Carboidratos {data['carb_g']} g | Gorduras {data['gord_g']} g\n\n"
+        "📅 *Divisão por refeição*\n"
+        f"{split_txt}\n\n"
+        "🍽️ *Cardápio exemplo*\n"
+        f"{CARDAPIO_TXT}\n\n"
+        f"{agua_txt}\n\n"
+        f"{TREINO_TXT}\n"
+        "ℹ️ Você receberá lembretes diários (água/refeições) e 1 *check-in semanal*. "
+        "Para desligar: *PAUSAR*. Para reativar: *ATIVAR*.\n\n"
+        "🧠 *Dica*: pode me perguntar qualquer coisa de treino/nutrição agora (ex.: \"posso trocar arroz por batata?\")."
+    )
+
+# Pós-conclusão / comandos de agendamento + Q&A livre
+def _step_999(text: str, body: str, uid: str, st: Dict[str, Any], data: Dict[str, Any]) -> str:
+    if text == "pausar":
+        st["schedule"]["enabled"] = False
+        return MSG_PAUSED
+    if text == "ativar":
+        st["schedule"]["enabled"] = True
+        return MSG_RESUMED
+
+    ai = _ai_answer(body, data)
+    if ai:
+        return ai
+    return MSG_DONE
+
+# step → handler (cada um devolve o texto de resposta e só altera st; build_reply grava no fim)
+_STEP_HANDLERS: Dict[int, Callable[..., str]] = {
+    0: _step_0, 1: _step_1, 2: _step_2, 4: _step_4, 5: _step_5, 6: _step_6,
+    7: _step_7, 8: _step_8, 9: _step_9, 91: _step_91,
+    100: _step_100, 101: _step_101, 102: _step_102,
+    11: _step_11, 12: _step_12, 999: _step_999,
+}
+
+# ---- Comandos globais (teste + utilitários) → handler(uid, st, sender)
+CMD_PING = frozenset({"ping", "status", "up"})
+CMD_RESET = frozenset({"reiniciar", "reset", "recomecar"})
+
+def _cmd_test_on(uid: str, st: Dict[str, Any], sender: str) -> str:
+    global TEST_MODE
+    TEST_MODE = True
+    norm_from = _normalize_e164(sender)
+    if norm_from:
+        TEST_TARGETS.add(norm_from)
+    return (
+        "🔔 *Modo TESTE 3 min ATIVADO*\n"
+        f"Alvos: {', '.join(sorted(TEST_TARGETS)) or '—'}\n"
+        "Use *#desativar3m* para desligar e *#status3m* para ver o status."
+    )
+
+def _cmd_test_off(uid: str, st: Dict[str, Any], sender: str) -> str:
+    global TEST_MODE
+    TEST_MODE = False
+    TEST_TARGETS.clear()
+    return "🛑 Modo TESTE desativado."
+
+def _cmd_test_status(uid: str, st: Dict[str, Any], sender: str) -> str:
+    onoff = "ON" if TEST_MODE else "OFF"
+    alvos = ", ".join(sorted(TEST_TARGETS)) or "—"
+    return f"ℹ️ TESTE: {onoff} | alvos: {alvos} | intervalo: {TEST_INTERVAL_MIN} min"
+
+def _cmd_ping(uid: str, st: Dict[str, Any], sender: str) -> str:
+    return MSG_ONLINE
+
+def _cmd_reset(uid: str, st: Dict[str, Any], sender: str) -> str:
+    st["step"] = 0; st["data"] = {}; st["schedule"] = {"last": {}}
+    set_fire_slots(uid, [])
+    return MSG_RESET
+
+_COMMANDS: Dict[str, Callable[[str, Dict[str, Any], str], str]] = {
+    TEST_SECRET: _cmd_test_on,
+    TEST_SECRET_OFF: _cmd_test_off,
+    TEST_SECRET_STATUS: _cmd_test_status,
+    **dict.fromkeys(CMD_PING, _cmd_ping),
+    **dict.fromkeys(CMD_RESET, _cmd_reset),
+}
+
+# mensagem sem mudança de estado renova updated_at (prazo do USER_TTL_DAYS) no máx. 1x por este intervalo
+_TOUCH_EVERY_S = 3600
+
 def build_reply(body: str, sender: str, waid: Optional[str], media_urls: Optional[List[str]] = None) -> str:
     """
     Fluxo — Boas-vindas → Q0 Nome → Anamnese (Q1–Q7) → Q8a–Q8c → Resultados Iniciais → Plano → ...
     + Q&A livre depois de concluir ou sob demanda.
     Estado: users[uid] = { flow:'ms', step:int, data:{...}, schedule:{...} }
     Comandos: oi | reiniciar | status | ping
+    Uma leitura e no máximo uma gravação por mensagem (estado mudou, ou atividade renovada 1x/hora).
     """
-    text = (body or "").strip().lower()
     uid = _uid_from(sender, waid)
-
-    db = load_db()
-    users = db.setdefault("users", {})
-    st = users.setdefault(uid, {"flow": "ms", "step": 0, "data": {}, "schedule": {"last": {}}})
+    st, seen = load_user_seen(uid)
+    st = st or _new_user_state()
+    before = dump_state(st)
+    st["last_from"] = sender  # destino dos lembretes do cron
+    reply = _route(body, sender, uid, st)
+    after = dump_state(st)
+    if after != before:
+        save_user(uid, st, after)
+    elif time.time() - seen >= _TOUCH_EVERY_S:
+        touch_user(uid, _TOUCH_EVERY_S)  # sem mudança, mas o usuário segue ativo
+    return reply
+
+def _route(body: str, sender: str, uid: str, st: Dict[str, Any]) -> str:
+    text = (body or "").strip().lower()
     step = int(st.get("step", 0))
 
     # --- NORMALIZADOR: permite resposta por letra (a->1, b->2, ...) ---
@@ -438,37 +1008,13 @@ def build_reply(body: str, sender: str, waid: Optional[str], media_urls: Optiona
             except Exception:
                 pass
 
-    data = st.get("data", {})
-    schedule = st.get("schedule", {"last": {}})
+    data = st.setdefault("data", {})
 
-    # === COMANDOS DE TESTE (sempre ativos) ===
-    global TEST_MODE, TEST_TARGETS
-    norm_from = _normalize_e164(sender)
-    if text == TEST_SECRET:
-        TEST_MODE = True
-        if norm_from:
-            TEST_TARGETS.add(norm_from)
-        return (
-            "🔔 *Modo TESTE 3 min ATIVADO*\n"
-            f"Alvos: {', '.join(sorted(TEST_TARGETS)) or '—'}\n"
-            "Use *#desativar3m* para desligar e *#status3m* para ver o status."
-        )
-    if text == TEST_SECRET_OFF:
-        TEST_MODE = False
-        TEST_TARGETS.clear()
-        return "🛑 Modo TESTE desativado."
-    if text == TEST_SECRET_STATUS:
-        onoff = "ON" if TEST_MODE else "OFF"
-        alvos = ", ".join(sorted(TEST_TARGETS)) or "—"
-        return f"ℹ️ TESTE: {onoff} | alvos: {alvos} | intervalo: {TEST_INTERVAL_MIN} min"
-
-    # ---- Comandos utilitários
-    if text in {"ping", "status", "up"}:
-        return "✅ Online. Digite **oi** para iniciar."
-    if text in {"reiniciar", "reset", "recomeçar", "recomecar"}:
-        st["step"] = 0; st["data"] = {}; st["schedule"] = {"last": {}}
-        users[uid] = st; save_db(db)
-        return "🔁 Reiniciado. Digite **oi** para começar."
+    # === COMANDOS GLOBAIS (teste + utilitários; valem em qualquer passo) ===
+    key = _fold(text)
+    cmd = _COMMANDS.get(key)
+    if cmd is not None:
+        return cmd(uid, st, sender)
 
     # ---- Q&A sob demanda antes de tudo (se o usuário perguntar algo e ainda não concluiu)
     if 0 < step < 999 and _maybe_route_to_ai(text, step):
@@ -476,350 +1022,24 @@ def build_reply(body: str, sender: str, waid: Optional[str], media_urls: Optiona
         if ai:
             return ai + "\n\n_(Para continuar o cadastro, responda conforme a última pergunta.)_"
 
-    # ---- Step 0 → Q0 (saudação + NOME)
-    if step == 0:
-        if text not in START_WORDS:
-            if _maybe_route_to_ai(text, step):
-                ai = _ai_answer(body, data)
-                if ai:
-                    return ai + "\n\nPara começar o plano, digite **oi**."
-            return "👋 Digite **oi** para iniciar."
-        st["step"] = 1; st["data"] = {}; users[uid] = st; save_db(db)
-        return (
-            "👋 *Bem-vindo ao Mete o Shape* 🚀\n"
-            "Aqui você terá acompanhamento completo de nutrição, treino e motivação.\n"
-            "Vamos começar rápido.\n\n"
-            "**Q0. Qual seu primeiro nome?**"
-        )
-
     # oi/ola no meio do fluxo sem reset
-    if text in START_WORDS and 0 < step < 999:
-        return "ℹ️ Estamos no processo. Para recomeçar: **reiniciar**."
-
-    # ===================== Q0 Nome =====================
-    if step == 1:
-        nome = (body or "").strip()
-        if not nome or len(nome) < 2:
-            return "❗ Me diga seu primeiro nome (ex.: Carlos)."
-        data["nome"] = nome.split()[0].title()
-        st["step"] = 2; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            "**Q1. Sexo**\n"
-            "a) Masculino\nb) Feminino\n_Responda a–b._"
-        )
+    if key in START_WORDS and 0 < step < 999:
+        return MSG_IN_FLOW
 
-    # ===================== ANAMNESE =====================
-    # Q1 (Sexo) → **pede idade EXATA (sem faixa)**
-    if step == 2:
-        if text not in {"1","2"}:
-            return "❗ Responda **1** (Masculino) ou **2** (Feminino)."
-        data["sexo"] = "Masculino" if text == "1" else "Feminino"
-        st["data"] = data; st["step"] = 4; users[uid] = st; save_db(db)
-        return "**Q2b. Qual sua idade EXATA (número)?**"
-
-    # Q2b (idade exata) → Q3 (altura)
-    if step == 4:
-        try:
-            idade_exata = int("".join(ch for ch in (body or "") if ch.isdigit()))
-        except Exception:
-            idade_exata = 0
-        if 10 < idade_exata < 100:
-            data["idade_exata"] = idade_exata
-        else:
-            data["idade_exata"] = data.get("idade_estimada", 30)
-        st["step"] = 5; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            "**Q3. Altura (faixa)**\n"
-            "a) <1,60 m\nb) 1,60–1,69 m\nc) 1,70–1,79 m\nd) 1,80–1,89 m\ne) ≥1,90 m\n_Responda a–e._"
-        )
-
-    # Q3 Altura → Q4 Peso
-    if step == 5:
-        if text not in HEIGHT_MAP:
-            return "❗ Altura: responda **1–5**."
-        low, high, mid = HEIGHT_MAP[text]
-        data["altura_faixa"] = f"{low}–{high} cm" if high != 205 else "≥190 cm"
-        data["altura_cm_est"] = mid
-        st["step"] = 6; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            "**Q4. Peso atual (faixa, kg)**\n"
-            "a) <60\nb) 60–69\nc) 70–79\nd) 80–89\ne) 90–99\nf) 100+\n_Responda a–f._"
-        )
-
-    # Q4 Peso → Q5 Atividade
-    if step == 6:
-        if text not in WEIGHT_MAP:
-            return "❗ Peso: responda **1–6**."
-        low, high, mid = WEIGHT_MAP[text]
-        data["peso_faixa"] = f"{low}–{high} kg" if high != 130 else "100+ kg"
-        data["peso_kg_est"] = mid
-        st["step"] = 7; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            "**Q5. Nível de atividade física**\n"
-            "a) Sedentário (0–1x/sem)\nb) Leve (2–3x/sem)\nc) Moderado (3–4x/sem)\nd) Intenso (5–6x/sem)\n_Responda a–d._"
-        )
-
-    # Q5 Atividade → Q6 Objetivo
-    if step == 7:
-        if text not in {"1","2","3","4"}:
-            return "❗ Atividade: responda **1–4**."
-        atividade = {"1":"Sedentário","2":"Leve","3":"Moderado","4":"Intenso"}[text]
-        data["atividade"] = atividade
-        st["step"] = 8; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            "**Q6. Objetivo principal**\n"
-            "a) Emagrecimento\nb) Definição/Manutenção\nc) Ganho de massa\n_Responda a–c._"
-        )
-
-    # Q6 Objetivo → Q7 Restrições
-    if step == 8:
-        if text not in {"1","2","3"}:
-            return "❗ Objetivo: responda **1–3**."
-        objetivo = {"1":"Emagrecimento","2":"Manutenção","3":"Hipertrofia"}[text]
-        data["objetivo"] = objetivo
-        st["step"] = 9; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            "**Q7. Restrições/observações**\n"
-            "a) Sem restrições\nb) Intolerância à lactose\nc) Vegetariano\nd) Low-carb\ne) Outras\n_Responda a–e._"
-        )
-
-    # Q7 → Observação livre (71) ou segue
-    if step == 9:
-        if text not in {"1","2","3","4","5"}:
-            return "❗ Responda **1–5**."
-        restr_map = {
-            "1":"Sem restrições",
-            "2":"Sem lactose",
-            "3":"Vegetariano",
-            "4":"Low-carb",
-            "5":"Outras"
-        }
-        data["restricoes"] = restr_map[text]
-        if text == "5":
-            st["step"] = 91; st["data"] = data; users[uid] = st; save_db(db)
-            return "✍️ Digite sua observação em uma frase curta (ex.: alergia a ovos)."
-        # pula fotos e vai direto para Q8a
-        st["step"] = 100; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            "**Q8a. Horário do TREINO**\n"
-            "a) 6h  b) 12h  c) 17h  d) 18h  e) 19h  f) 20h  g) Não treino  h) Outro (0–23)\n"
-            "_Responda a–h._"
-        )
-
-    if step == 91:
-        obs = (body or "").strip()
-        if not obs:
-            return "❗ Escreva uma observação curta (texto)."
-        data["restricoes_obs"] = obs
-        # pula fotos e vai direto para Q8a
-        st["step"] = 100; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            "**Q8a. Horário do TREINO**\n"
-            "a) 6h  b) 12h  c) 17h  d) 18h  e) 19h  f) 20h  g) Não treino  h) Outro (0–23)\n"
-            "_Responda a–h._"
-        )
-
-    # ===================== Q8a/Q8b/Q8c (perfil de alertas) =====================
-    if step == 100:
-        opt = text
-        map_opt = {"1":6,"2":12,"3":17,"4":18,"5":19,"6":20}
-        if opt in map_opt:
-            data["training_hour"] = map_opt[opt]
-        elif opt == "7":
-            data["training_hour"] = None
-        elif opt == "8":
-            return "Digite a hora do treino (0–23), número inteiro."
-        else:
-            try:
-                h = _clamp_hour(int(opt))
-                data["training_hour"] = h
-            except Exception:
-                return "❗ Responda 1–8 ou uma hora válida (0–23)."
-        st["data"] = data; st["step"] = 101; users[uid] = st; save_db(db)
-        return (
-            "**Q8b. Janela de ALIMENTAÇÃO (HH–HH)**\n"
-            "a) 08–20  b) 07–21  c) 06–22  d) 10–18  e) Outra (digite HH–HH)\n"
-            "_Responda a–e._"
-        )
-
-    if step == 101:
-        preset = {"1":(8,20), "2":(7,21), "3":(6,22), "4":(10,18)}
-        if text in preset:
-            data["feeding_window"] = list(preset[text])
-        else:
-            rng = _parse_hh_range(body or "")
-            if not rng:
-                return "❗ Formato inválido. Envie no formato HH–HH (ex.: 08–20)."
-            data["feeding_window"] = [rng[0], rng[1]]
-        st["data"] = data; st["step"] = 102; users[uid] = st; save_db(db)
-        return (
-            "**Q8c. Silêncio/Não perturbe (HH–HH)**\n"
-            "a) 22–05  b) 23–06  c) 00–06  d) Não silenciar  e) Outra (HH–HH)\n"
-            "_Responda a–e._"
-        )
-
-    if step == 102:
-        if text == "4":
-            data["mute_hours"] = None
-        elif text in {"1","2","3"}:
-            preset = {"1":(22,5), "2":(23,6), "3":(0,6)}
-            data["mute_hours"] = [preset[text][0], preset[text][1]]
-        else:
-            rng = _parse_hh_range(body or "")
-            if not rng:
-                return "❗ Formato inválido. Envie HH–HH (ex.: 22–05) ou escolha 1–4."
-            data["mute_hours"] = [rng[0], rng[1]]
-        st["data"] = data; st["step"] = 11; users[uid] = st; save_db(db)
-        nome = data.get("nome","")
-        return (
-            "✅ *Resumo rápido*\n"
-            f"Nome: {nome}\n"
-            f"Sexo: {data['sexo']} | Idade: {data.get('idade_exata', data.get('idade_estimada'))} anos\n"
-            f"Altura: {data['altura_faixa']} | Peso: {data['peso_faixa']}\n"
-            f"Atividade: {data['atividade']} | Objetivo: {data['objetivo']}\n"
-            f"Restrições: {data.get('restricoes')} {('('+data.get('restricoes_obs','')+')') if data.get('restricoes_obs') else ''}\n"
-            f"Treino: {('sem treino' if data.get('training_hour') is None else str(data.get('training_hour'))+'h')}\n"
-            f"Janela: {tuple(data.get('feeding_window',[8,20]))}\n"
-            f"Silêncio: {('nenhum' if data.get('mute_hours') in (None,[]) else tuple(data.get('mute_hours')))}\n\n"
-            "**Confirmar?**\na) Confirmar\nb) Reiniciar"
-        )
-
-    # Confirmação → Resultados Iniciais
-    if step == 11:
-        if text == "2":
-            st["step"] = 0; st["data"] = {}; users[uid] = st; save_db(db)
-            return "🔁 Reiniciado. Digite **oi** para começar."
-        if text != "1":
-            return "❗ Responda **1** para Confirmar ou **2** para Reiniciar."
-
-        sexo   = data.get("sexo", "Masculino")
-        idade  = int(data.get("idade_exata", data.get("idade_estimada", 30)))
-        peso   = float(data.get("peso_kg_est", 75.0))
-        altura = float(data.get("altura_cm_est", 175.0))
-        objetivo  = data.get("objetivo", "Manutenção")
-        atividade = data.get("atividade", "Leve")
-        nome      = data.get("nome","")
-
-        tmb = _calc_tmb_mifflin(sexo, peso, altura, idade)
-        tdee = _calc_get(tmb, atividade)
-        cal_alvo = _apply_objective(tdee, objetivo)
-        cal_final = max(1200, _round(cal_alvo, base=10))
-        prot_g, carb_g, gord_g = _calc_macros(peso, cal_final)
-
-        data.update({
-            "tmb": int(round(tmb)),
-            "tdee": int(round(tdee)),
-            "calorias": cal_final,
-            "prot_g": prot_g, "carb_g": carb_g, "gord_g": gord_g
-        })
-
-        st["step"] = 12; st["data"] = data; users[uid] = st; save_db(db)
-        return (
-            f"📊 *Resultados Iniciais — {nome} ({idade} anos)*\n"
-            f"TMB: {data['tmb']} kcal\n"
-            f"TDEE (atividade): {data['tdee']} kcal\n"
-            f"Calorias meta ({objetivo}): {data['calorias']} kcal/dia\n"
-            f"Macros: Proteína {prot_g} g | Carboidratos {carb_g} g | Gorduras {gord_g} g\n\n"
-            "**Q9. Quantas refeições por dia você prefere?**\n"
-            "a) 3\nb) 4\nc) 5\nd) 6+\n_Responda a–d._"
-        )
-
-    # Q9 — Nº de refeições → Plano + Cardápio + Hidratação + Treino
-    if step == 12:
-        if text not in {"1","2","3","4"}:
-            return "❗ Refeições: responda **1–4**."
-        meals = {"1":3, "2":4, "3":5, "4":6}[text]
-        data["meal_count"] = meals
-
-        kcal_split = _split_by_meals(int(data["calorias"]), meals)
-        p_split = _split_by_meals(int(data["prot_g"]), meals)
-        c_split = _split_by_meals(int(data["carb_g"]), meals)
-        g_split = _split_by_meals(int(data["gord_g"]), meals)
-        data.update({"split_kcal": kcal_split, "split_p": p_split, "split_c": c_split, "split_g": g_split})
-
-        # Hidratação (37 ml/kg)
-        peso = float(data.get("peso_kg_est", 75.0))
-        agua_ml = int(round(peso * 37))
-        agua_l = max(2, round(agua_ml/1000, 1))
-        agua_manha = round(agua_l * 0.33, 1)
-        agua_tarde = round(agua_l * 0.37, 1)
-        agua_noite = round(agua_l * 0.30, 1)
-        data.update({"agua_l": agua_l, "agua_split": {"manhã": agua_manha, "tarde": agua_tarde, "noite": agua_noite}})
-
-        treino_txt = (
-            "🏋️ *Treino (ABC sugerido)*\n"
-            "A: Peito, Ombro, Tríceps\n"
-            "B: Costas, Bíceps\n"
-            "C: Pernas, Abdômen\n"
-            "Frequência: 3x/sem (ABC) ou 6x/sem (ABC duas vezes)\n"
-        )
-
-        linhas_split = []
-        for i in range(1, meals+1):
-            k = f"Ref {i}"
-            linhas_split.append(
-                f"- {k}: {kcal_split[k]} kcal | Proteína {p_split[k]} g | Carboidratos {c_split[k]} g | Gorduras {g_split[k]} g"
-            )
-        split_txt = "\n".join(linhas_split)
-
-        cardapio_txt = _render_cardapio()
-        agua_txt = f"💧 *Hidratação*: ~{agua_l} L/dia (manhã {agua_manha} L, tarde {agua_tarde} L, noite {agua_noite} L)."
-        nome = data.get("nome",""); idade = int(data.get("idade_exata", data.get("idade_estimada", 30)))
-
-        st["step"] = 999
-        st["data"] = data
-        schedule.setdefault("last", {})
-        schedule["enabled"] = True
-        st["schedule"] = schedule
-        users[uid] = st
-        save_db(db)
-
-        # Texto único (será splitado na camada TwiML/REST)
-        return (
-            f"🔥 *Plano Inicial — {nome} ({idade} anos)*\n\n"
-            f"Calorias: {data['calorias']} kcal/dia\n"
-            f"Macros: Proteína {data['prot_g']} g | Carboidratos {data['carb_g']} g | Gorduras {data['gord_g']} g\n\n"
-            "📅 *Divisão por refeição*\n"
-            f"{split_txt}\n\n"
-            "🍽️ *Cardápio exemplo*\n"
-            f"{cardapio_txt}\n\n"
-            f"{agua_txt}\n\n"
-            f"{treino_txt}\n"
-            "ℹ️ Você receberá lembretes diários (água/refeições) e 1 *check-in semanal*. "
-            "Para desligar: *PAUSAR*. Para reativar: *ATIVAR*.\n\n"
-            "🧠 *Dica*: pode me perguntar qualquer coisa de treino/nutrição agora (ex.: \"posso trocar arroz por batata?\")."
-        )
-
-    # Pós-conclusão / comandos de agendamento + Q&A livre
-    if step >= 999:
-        if text == "pausar":
-            st["schedule"]["enabled"] = False
-            users[uid] = st; save_db(db)
-            return "⏸️ Lembretes pausados. Envie *ATIVAR* para reativar."
-        if text == "ativar":
-            st["schedule"]["enabled"] = True
-            users[uid] = st; save_db(db)
-            return "▶️ Lembretes reativados. Você receberá mensagens ao longo do dia."
-
-        ai = _ai_answer(body, data)
-        if ai:
-            return ai
-        return (
-            "✅ Fluxo concluído.\n"
-            "• *reiniciar* para recomeçar\n"
-            "• *pausar* ou *ativar* lembretes\n"
-            "• Pode me perguntar dúvidas de treino/nutrição 👍"
-        )
+    handler = _STEP_HANDLERS.get(999 if step >= 999 else step)
+    if handler:
+        return handler(text, body, uid, st, data)
 
     # Fallback — tenta Q&A antes de desistir
     ai = _ai_answer(body, data)
     if ai:
         return ai + "\n\n_(Para continuar o cadastro, responda conforme a última pergunta.)_"
-    return "❓ Não entendi. Digite **oi** para iniciar ou **reiniciar** para recomeçar."
+    return MSG_FALLBACK
 
 # ===================== CRON: mensagens diárias + check-in semanal =====================
 
 WEEKDAY_CHECKIN = 0  # 0=segunda-feira
+CHECKIN_HOUR = 8     # a partir desta hora (com recuperação ao longo do dia)
 
 # --- Executor do modo TESTE ---
 def _run_cron_test_now(log) -> int:
@@ -835,10 +1055,8 @@ def _run_cron_test_now(log) -> int:
         log.info("[test-cron] sem alvos")
         return 0
     body = f"🔔 [TESTE] {now.strftime('%d/%m %H:%M:%S')} — lembrete 3m ativo."
-    sent = 0
-    for raw in list(TEST_TARGETS):
-        if _send_whatsapp(raw, body, log):
-            sent += 1
+    results = _TWILIO_POOL.map(lambda raw: _send_whatsapp(raw, body, log), list(TEST_TARGETS))
+    sent = sum(1 for ok in results if ok)
     TEST_LAST_TS = now.timestamp()
     log.info(f"[test-cron] sent={sent}")
     return sent
@@ -849,95 +1067,64 @@ def _distribute_meal_hours(A: int, B: int, count: int) -> List[int]:
     if A > B:  # janela inválida para refeições
         return []
     if count == 1: return [A]
-    hours = []
-    span = B - A
-    for i in range(count):
-        h = int(round(A + (span * (i/(count-1)))))
-        hours.append(_clamp_hour(h))
-    # dedup mantendo ordem
-    seen=set(); out=[]
-    for h in hours:
-        if h not in seen:
-            out.append(h); seen.add(h)
-    return sorted(out)
+    # interpolação inteira com arredondamento .5 para cima (sem float)
+    span = B - A; d = count - 1
+    return sorted({_clamp_hour(A + (span * i + d // 2) // d) for i in range(count)})
 
 def _force_post_workout(meals: List[int], A: int, B: int, T: Optional[int]) -> List[int]:
-    if T is None: return sorted(meals)
-    if not _in_window(T, A, B): return sorted(meals)
+    """Puxa a refeição mais próxima para T+1. 'meals' já vem ordenada e sem repetição."""
+    if T is None: return meals
+    if not _in_window(T, A, B): return meals
     target = min(B, T+1)
-    if target in meals: return sorted(meals)
+    if target in meals: return meals
     if not meals: return [target]
     idx = min(range(len(meals)), key=lambda i: abs(meals[i]-target))
     meals[idx] = target
-    return sorted(list(set(meals)))
+    meals.sort()
+    return meals
 
 def _water_slots(meals: List[int], A: int, B: int, avoid: set, need: int = 3) -> List[int]:
-    """Escolhe até 3 horas cheias entre as refeições; evita colisões com 'avoid'; respeita janela."""
+    """Escolhe até 3 horas cheias entre as refeições (ordenadas); evita colisões com 'avoid'; respeita janela."""
     cand: List[int] = []
-    m = sorted(meals)
+    m = meals
     if len(m) >= 2:
         for i in range(len(m)-1):
-            mid = int(round((m[i]+m[i+1])/2))
+            mid = (m[i] + m[i+1] + 1) // 2
             if _in_window(mid, A, B): cand.append(mid)
-    while len(cand) < need and A <= B:
-        slots = [int(round(A + (B-A)*p)) for p in [1/4, 2/4, 3/4]]
-        for s in slots:
+    if len(cand) < need and A <= B:
+        # quartos da janela (1/4, 2/4, 3/4), arredondados para cima no .5
+        for k in (1, 2, 3):
             if len(cand) >= need: break
+            s = A + ((B - A) * k + 2) // 4
             if _in_window(s, A, B): cand.append(s)
-        break
-    seen=set(); out=[]
-    for h in cand:
-        if h not in seen and h not in avoid:
-            out.append(h); seen.add(h)
-    return sorted(out)[:need]
-
-def _should_send(last: Dict[str,str], key: str, now: datetime, h: int) -> bool:
-    """Marca e libera 1x por dia/hora (idempotência)."""
-    today_key = now.strftime("%Y-%m-%d") + f"@{h}"
-    if last.get(key) == today_key:
-        return False
-    last[key] = today_key
-    return True
+    return sorted(set(cand).difference(avoid))[:need]
 
-def _cron_payload_for(uid: str, u: Dict[str, Any], log) -> List[Tuple[str, str]]:
-    """Retorna lista de (to, body) a enviar agora, calculado por PERFIL."""
-    to_num = u.get("last_from") or ""  # salvo no /bot
-    if not to_num:
-        return []
-    sched = (u.get("schedule") or {})
-    if not sched.get("enabled", True):
-        return []
-    last = sched.get("last", {})
-    data = (u.get("data") or {})
+def _day_int(now: datetime) -> int:
+    return now.year * 10000 + now.month * 100 + now.day
 
-    now = _now_br()
-    hour = now.hour
-    weekday = now.weekday()
+def _should_send(fired: set, key: int) -> bool:
+    """Marca e libera 1x por chave aaaammdd·tipo·hora (idempotência)."""
+    if key in fired:
+        return False
+    fired.add(key)
+    return True
 
-    fw = data.get("feeding_window", [8,20])
-    A, B = int(fw[0]), int(fw[1])
+def _fire_slots(data: Dict[str, Any]) -> List[List[Any]]:
+    """[hora, tipo] de cada lembrete diário do PERFIL, na ordem de envio.
+    Calculado no commit do plano e salvo em schedule.slots (o cron só consulta)."""
+    A, B = _unpack_hh(data.get("feeding_window")) or (8, 20)
     meal_count = int(data.get("meal_count", 4))
-    T = data.get("training_hour", None)
-    if isinstance(T, str) and T.isdigit(): T = int(T)
-    if isinstance(T, float): T = int(T)
-    if T is not None: T = _clamp_hour(T)
-
-    mute = data.get("mute_hours", [22,5])
-    mute_tuple: Optional[Tuple[int,int]]
-    if mute in (None, []):
-        mute_tuple = None
-    else:
-        mute_tuple = (_clamp_hour(mute[0]), _clamp_hour(mute[1]))
+    T = data.get("training_hour")  # já normalizado (int 0–23 ou None) no commit do plano
+
+    mute_tuple = _unpack_hh(data.get("mute_hours", [22,5]))
 
     def not_muted(h: int) -> bool:
         if mute_tuple is None: return True
         return not _in_mute(h, mute_tuple[0], mute_tuple[1])
 
-    out: List[Tuple[str, str]] = []
-
     meals = _distribute_meal_hours(A, B, meal_count)
     meals = _force_post_workout(meals, A, B, T)
-    meals = sorted(h for h in meals if not_muted(h))
+    meals = [h for h in meals if not_muted(h)]
 
     water = _water_slots(meals, A, B, avoid=set(meals), need=3)
     water = [h for h in water if not_muted(h)]
@@ -950,24 +1137,52 @@ def _cron_payload_for(uid: str, u: Dict[str, Any], log) -> List[Tuple[str, str]]
     if pre is not None and not_muted(pre): train_slots.append(("pretreino", pre))
     if post is not None and not_muted(post): train_slots.append(("pos_treino", post))
 
-    for i, h in enumerate(meals, start=1):
-        if h == hour and _should_send(last, f"meal_{h}", now, h):
-            out.append((to_num, f"🍽️ *Refeição {i}* agora ({h:02d}:00). Mantenha as porções do plano."))
+    return ([[h, "meal"] for h in meals]
+            + [[h, "agua"] for h in water]
+            + [[h, tag] for tag, h in train_slots])
+
+SLOT_MSGS = {
+    "agua": "💧 Lembrete de água. Pequenos goles agora. Meta diária em andamento.",
+    "pretreino": "⚡ Pré-treino (T−1h): aquece, técnica limpa, foco total.",
+    "pos_treino": "✅ Pós-treino (T+1h): proteína + carbo limpo. Marca no app como feito.",
+}
+
+# tipo de slot → dígitos da chave de idempotência (aaaammdd * 10000 + id * 100 + hora)
+_SLOT_KIND_ID = {"meal": 1, "agua": 2, "pretreino": 3, "pos_treino": 4}
+
+def _cron_payload_for(uid: str, u: Dict[str, Any], log, now: datetime,
+                      checkin: bool = False) -> List[Tuple[str, str]]:
+    """Retorna lista de (to, body) a enviar em 'now' (hora do tick), a partir dos slots salvos no PERFIL.
+    checkin: uid veio de uids_checkin_due (plano concluído com check-in pendente hoje)."""
+    to_num = u.get("last_from") or ""  # salvo no /bot
+    if not to_num:
+        return []
+    sched = (u.get("schedule") or {})
+    if not sched.get("enabled", True):
+        return []
+    last = sched.get("last", {})
+    # disparos do dia: chaves de ontem para trás são descartadas aqui
+    today = _day_int(now)
+    fired = {k for k in sched.get("fired", ()) if k // 10000 == today}
+
+    hour = now.hour
 
-    for j, h in enumerate(water, start=1):
-        if h == hour and _should_send(last, f"agua_{h}", now, h):
-            out.append((to_num, "💧 Lembrete de água. Pequenos goles agora. Meta diária em andamento."))
+    out: List[Tuple[str, str]] = []
 
-    for tag, h in train_slots:
-        if h == hour and _should_send(last, f"{tag}_{h}", now, h):
-            if tag == "pretreino":
-                out.append((to_num, "⚡ Pré-treino (T−1h): aquece, técnica limpa, foco total."))
-            else:
-                out.append((to_num, "✅ Pós-treino (T+1h): proteína + carbo limpo. Marca no app como feito."))
+    meal_i = 0
+    for h, kind in sched.get("slots", []):
+        if kind == "meal":
+            meal_i += 1
+        if h != hour or not _should_send(fired, today * 10000 + _SLOT_KIND_ID[kind] * 100 + h):
+            continue
+        if kind == "meal":
+            out.append((to_num, f"🍽️ *Refeição {meal_i}* agora ({h:02d}:00). Mantenha as porções do plano."))
+        else:
+            out.append((to_num, SLOT_MSGS[kind]))
 
     ck_key = "checkin"
     ck_mark = last.get(ck_key)
-    if weekday == WEEKDAY_CHECKIN and hour >= 8:
+    if checkin:
         today_ck = now.strftime("%Y-%m-%d")
         if ck_mark != today_ck:
             last[ck_key] = today_ck
@@ -977,32 +1192,137 @@ def _cron_payload_for(uid: str, u: Dict[str, Any], log) -> List[Tuple[str, str]]
                 "Responda aqui que ajusto suas calorias/macros se precisar."
             ))
 
-    u.setdefault("schedule", {})["last"] = last
+    sched_out = u.setdefault("schedule", {})
+    sched_out["last"] = last
+    sched_out["fired"] = sorted(fired)
     return out
 
+def _backfill_fire_slots(log) -> None:
+    """Planos concluídos antes do índice de horários ganham slots + linhas no índice.
+    Os candidatos saem de uma consulta SQL (sem decodificar a base); depois da 1ª vez, nenhum."""
+    for uid in uids_without_slots():
+        with _uid_lock(uid):
+            st = load_user(uid)
+            if not st:
+                continue
+            schedule = st.setdefault("schedule", {"last": {}})
+            if "slots" not in schedule:
+                data = st.setdefault("data", {})
+                data["training_hour"] = _norm_hour(data.get("training_hour"))
+                schedule["slots"] = _fire_slots(data)
+                save_user(uid, st)
+            set_fire_slots(uid, schedule["slots"] + [[CHECKIN_HOUR, "checkin"]])
+        log.info(f"[cron] slots indexados uid={uid}")
 
-def _remember_last_from(users: Dict[str, Any], uid: str, sender: str):
-    users[uid]["last_from"] = sender
 
 # ===================== Cron helpers reutilizáveis =====================
 
+# usuários por lote do cron (uma leitura + uma transação de escrita por lote)
+_CRON_BATCH = 256
+
 def _run_cron_now(log) -> int:
-    """Executa a mesma lógica do /admin/cron e retorna quantas mensagens foram enviadas."""
-    db = load_db()
-    users = db.get("users", {})
+    """Executa a mesma lógica do /admin/cron e retorna quantas mensagens foram enviadas.
+    Só carrega quem tem lembrete nesta hora (índice schedule_fire), não a base inteira;
+    no dia do check-in, só quem ainda não teve o check-in resolvido hoje."""
+    now = _now_br()
+    uids = set(uids_for_hour(now.hour))
+    ck_day = None
+    ck_due: set = set()
+    if now.weekday() == WEEKDAY_CHECKIN and now.hour >= CHECKIN_HOUR:
+        ck_day = now.strftime("%Y-%m-%d")
+        ck_due = set(uids_checkin_due(ck_day))
+        uids |= ck_due
     total_msgs = 0
-    for uid, u in users.items():
+    pending = []
+    ordered = sorted(uids)
+    def payloads_of(uid: str, u: Optional[Dict[str, Any]]) -> Optional[List[Tuple[str, str]]]:
         try:
-            payloads = _cron_payload_for(uid, u, log)
-            for to, body in payloads:
-                _send_whatsapp(to, body, log)
-                total_msgs += 1
+            return _cron_payload_for(uid, u, log, now, uid in ck_due) if u else []
         except Exception as e:
             log.error(f"[internal-cron] error uid={uid}: {e}")
-    save_db(db)
+            return None
+    for b in range(0, len(ordered), _CRON_BATCH):
+        batch = ordered[b:b + _CRON_BATCH]
+        to_send: List[Tuple[str, List[Tuple[str, str]]]] = []
+        try:
+            # 1ª passada sem travas (cópias descartadas): quem não tem nada a disparar para aqui
+            users = load_users(batch)
+            due = []
+            ck_done = []
+            for uid in batch:
+                payloads = payloads_of(uid, users.get(uid))
+                if payloads:
+                    due.append(uid)
+                elif payloads is not None and uid in ck_due:
+                    # já marcado ou não se aplica (pausado/sem número/removido): sai da consulta do dia
+                    ck_done.append(uid)
+            # 2ª passada: releitura + uma transação de escrita com as listras travadas (sem esperar)
+            with _try_uid_locks(due) as locked:
+                if len(locked) < len(due):
+                    log.info(f"[internal-cron] {len(due) - len(locked)} uid(s) ocupado(s); próximo tick")
+                fresh = load_users(locked)
+                changed = []
+                for uid in locked:
+                    u = fresh.get(uid)
+                    payloads = payloads_of(uid, u)
+                    if payloads is None:
+                        continue
+                    if payloads:
+                        changed.append((uid, u))
+                        to_send.append((uid, payloads))
+                    if uid in ck_due:
+                        ck_done.append(uid)
+                save_users(changed)
+            mark_checkin_sent(ck_done, ck_day)
+        except Exception as e:
+            log.error(f"[internal-cron] batch error ({len(batch)} uids): {e}")
+            continue
+        for uid, payloads in to_send:
+            pending.append((uid, _TWILIO_POOL.submit(_send_many, payloads, log)))
+            total_msgs += len(payloads)
+    # espera o lote terminar para o próximo tick não sobrepor envios
+    for uid, fut in pending:
+        try:
+            fut.result()
+        except Exception as e:
+            log.error(f"[internal-cron] send error uid={uid}: {e}")
     return total_msgs
 
 
+# impede ticks sobrepostos (tick lento + próximo disparo) no mesmo processo
+_TICK_LOCK = threading.Lock()
+
+# cadastros nunca concluídos (sem lembretes) somem após N dias sem mensagem; 0 desliga
+USER_TTL_DAYS = int(os.getenv("USER_TTL_DAYS", "30"))
+_PRUNE_DAY = None
+
+def _maybe_prune(log) -> None:
+    """Limpeza de usuários abandonados, no máximo 1x por dia por processo."""
+    global _PRUNE_DAY
+    today = _now_br().date()
+    if USER_TTL_DAYS <= 0 or _PRUNE_DAY == today:
+        return
+    _PRUNE_DAY = today
+    n = prune_stale_users(USER_TTL_DAYS * 86400)
+    if n:
+        log.info(f"[scheduler] {n} usuário(s) inativo(s) removido(s)")
+
+def _scheduler_tick(log) -> None:
+    """Um tick do agendador: decide TEST/PROD em runtime; pula se o anterior ainda roda."""
+    if not _TICK_LOCK.acquire(blocking=False):
+        log.warning("[scheduler] tick anterior ainda em execução; pulando")
+        return
+    try:
+        if TEST_MODE:
+            _run_cron_test_now(log)
+        else:
+            _run_cron_now(log)
+        _maybe_prune(log)
+    except Exception as ex:
+        log.error(f"[scheduler] tick error: {ex}")
+    finally:
+        _TICK_LOCK.release()
+
 def _start_internal_scheduler(log):
     """Agendador: checa TEST_MODE a cada minuto e dispara o executor correto."""
     global _SCHED_STARTED
@@ -1011,29 +1331,18 @@ def _start_internal_scheduler(log):
     try:
         from apscheduler.schedulers.background import BackgroundScheduler  # type: ignore
         scheduler = BackgroundScheduler(timezone=TZ)
-        def _tick():
-            try:
-                if TEST_MODE:
-                    _run_cron_test_now(log)
-                else:
-                    _run_cron_now(log)
-            except Exception as ex:
-                log.error(f"[scheduler] tick error: {ex}")
-        scheduler.add_job(_tick, "cron", minute="*")  # roda a cada 1 minuto
+        # roda a cada 1 minuto; atrasos viram UM disparo (sem fila de execuções duplicadas)
+        scheduler.add_job(lambda: _scheduler_tick(log), "cron", minute="*",
+                          coalesce=True, max_instances=1, misfire_grace_time=30)
         scheduler.start()
         log.info("[scheduler] iniciado (tick 1 min; TEST/PROD decidido em runtime)")
     except Exception as e:
         log.warning(f"[scheduler] APScheduler indisponível ({e}); usando loop em thread")
         def _loop():
             while True:
-                try:
-                    if TEST_MODE:
-                        _run_cron_test_now(log)
-                    else:
-                        _run_cron_now(log)
-                except Exception as ex:
-                    log.error(f"[scheduler] loop error: {ex}")
-                time.sleep(60)
+                _scheduler_tick(log)
+                # dorme até a próxima virada de minuto do relógio (sem acumular o tempo do tick)
+                time.sleep(60 - (time.time() % 60))
         t = threading.Thread(target=_loop, daemon=True)
         t.start()
         log.info("[scheduler] Thread de agendamento iniciada (60s)")
@@ -1041,27 +1350,60 @@ def _start_internal_scheduler(log):
 
 # ===================== Flask app / rotas =====================
 
+# até 3 anexos por mensagem são repassados ao fluxo
+_MEDIA_KEYS = ("MediaUrl0", "MediaUrl1", "MediaUrl2")
+
+# respostas fixas → TwiML já codificado em UTF-8 (sem split/escape/encode por requisição)
+_TWIML_CONST: Dict[str, bytes] = {
+    t: _twiml(_split_for_whatsapp(t, WHATSAPP_CHAR_LIMIT)).encode("utf-8")
+    for t in (MSG_ONLINE, MSG_RESET, MSG_IN_FLOW, MSG_PAUSED, MSG_RESUMED, MSG_DONE,
+              MSG_FALLBACK, MSG_ERROR, WELCOME_TEXT, Q1_TEXT, Q2B_TEXT, Q3_TEXT, Q4_TEXT,
+              Q5_TEXT, Q6_TEXT, Q7_TEXT, Q7_OBS_TEXT, Q8A_TEXT, Q8B_TEXT, Q8C_TEXT)
+}
+
+# health-checks (monitores batem a cada poucos segundos): respondidos antes do Flask, sem contexto/roteamento
+_FAST_GET: Dict[str, bytes] = {
+    "/": "OK / (root) – use /bot (GET/POST), /admin/ping ou /admin/cron".encode("utf-8"),
+    "/admin/ping": b"OK /admin/ping",
+    "/health": b"ok",
+}
+
+_FAST_ALLOW = ("Allow", "GET, HEAD, OPTIONS")
+
+def _fast_paths(wsgi_app):
+    def _app(environ, start_response):
+        body = _FAST_GET.get(environ.get("PATH_INFO", "").rstrip("/") or "/")
+        if body is None:
+            return wsgi_app(environ, start_response)
+        method = environ.get("REQUEST_METHOD")
+        if method in ("GET", "HEAD"):
+            start_response("200 OK", [("Content-Type", "text/plain; charset=utf-8"),
+                                      ("Content-Length", str(len(body)))])
+            return [b"" if method == "HEAD" else body]
+        # mesmo contrato das rotas GET do Flask: OPTIONS → 200, resto → 405, ambos com Allow
+        if method == "OPTIONS":
+            start_response("200 OK", [_FAST_ALLOW, ("Content-Length", "0")])
+            return [b""]
+        msg = b"405 Method Not Allowed"
+        start_response("405 Method Not Allowed", [_FAST_ALLOW, ("Content-Type", "text/plain; charset=utf-8"),
+                                                  ("Content-Length", str(len(msg)))])
+        return [msg]
+    return _app
+
 def create_app() -> Flask:
     app = Flask(__name__)
     app.url_map.strict_slashes = False
+    app.wsgi_app = _fast_paths(app.wsgi_app)
 
     logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
     log = logging.getLogger(APP_NAME)
 
+    try:
+        _backfill_fire_slots(log)
+    except Exception as e:
+        log.error(f"[cron] backfill de slots falhou: {e}")
     _start_internal_scheduler(log)
 
-    @app.route("/", methods=["GET"])
-    def root():
-        return Response("OK / (root) – use /bot (GET/POST), /admin/ping ou /admin/cron", 200, mimetype="text/plain")
-
-    @app.route("/admin/ping", methods=["GET"])
-    def admin_ping():
-        return Response("OK /admin/ping", 200, mimetype="text/plain")
-
-    @app.route("/health", methods=["GET"])
-    def health():
-        return Response("ok", 200, mimetype="text/plain")
-
     @app.route("/admin/cron", methods=["GET"])
     def admin_cron():
         use_test = TEST_MODE or (request.args.get("test") == "1")
@@ -1074,48 +1416,42 @@ def create_app() -> Flask:
             log.info("GET /bot -> 200 (health-check)")
             return Response("OK /bot (GET) – use POST via Twilio", 200, mimetype="text/plain")
 
-        body: str = (request.values.get("Body") or "").strip()
-        sender: str = request.values.get("From", "")
-        waid: Optional[str] = request.values.get("WaId")
+        # Twilio envia form-urlencoded: lê o form uma vez (request.values combinaria form+args a cada get)
+        vals = request.form
+        body: str = (vals.get("Body") or "").strip()
+        sender: str = vals.get("From", "")
+        waid: Optional[str] = vals.get("WaId")
 
         # Coleta mídias (Twilio: NumMedia, MediaUrl0..)
         try:
-            num_media = int(request.values.get("NumMedia", "0"))
+            num_media = int(vals.get("NumMedia", "0"))
         except Exception:
             num_media = 0
         media_urls: List[str] = []
-        if num_media > 0:
-            for i in range(min(num_media, 3)):
-                url = request.values.get(f"MediaUrl{i}")
-                if url:
-                    media_urls.append(url)
+        for key in _MEDIA_KEYS[:max(0, num_media)]:
+            url = vals.get(key)
+            if url:
+                media_urls.append(url)
 
         log.info(f"POST /bot <- From={sender} WaId={waid} BodyLen={len(body)} Media={len(media_urls)}")
 
-        # lembrar destino para cron
-        try:
-            db = load_db()
-            users = db.setdefault("users", {})
-            uid = _uid_from(sender, waid)
-            users.setdefault(uid, {"flow":"ms","step":0,"data":{},"schedule":{"last":{}}})
-            _remember_last_from(users, uid, sender)
-            save_db(db)
-        except Exception:
-            pass
+        uid = _uid_from(sender, waid)
+        with _uid_lock(uid):
+            try:
+                reply_text = _safe_reply(build_reply(body=body, sender=sender, waid=waid, media_urls=media_urls))
+            except Exception as e:
+                app.logger.exception(f"Erro no build_reply: {e}")
+                reply_text = MSG_ERROR
 
-        try:
-            reply_text = _safe_reply(build_reply(body=body, sender=sender, waid=waid, media_urls=media_urls))
-        except Exception as e:
-            app.logger.exception(f"Erro no build_reply: {e}")
-            reply_text = "⚠️ Tive um erro aqui. Mande **reiniciar** ou **oi** para seguir."
+        raw = _TWIML_CONST.get(reply_text)
+        if raw is not None:
+            log.info("POST /bot -> ReplyParts=1 totalLen=%d (fixa)", len(reply_text))
+            return Response(raw, 200, mimetype="application/xml; charset=utf-8")
 
         chunks = _split_for_whatsapp(reply_text, WHATSAPP_CHAR_LIMIT)
         log.info("POST /bot -> ReplyParts=%d totalLen=%d", len(chunks), sum(len(c) for c in chunks))
 
-        twiml = MessagingResponse()
-        for ch in chunks:
-            twiml.message(ch)
-        return Response(str(twiml), 200, mimetype="application/xml; charset=utf-8")
+        return Response(_twiml(chunks), 200, mimetype="application/xml; charset=utf-8")
 
     @app.errorhandler(404)
     def not_found(_e):
@@ -1130,10 +1466,12 @@ print("[server] app criado")
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8080"))
     host = os.getenv("HOST", "0.0.0.0")
+    # /bot bloqueia em I/O (SQLite, OpenAI): mais threads = mais webhooks simultâneos por processo
+    threads = int(os.getenv("WEB_THREADS", "16"))
     try:
         from waitress import serve
-        print(f"[server] Servindo com waitress em http://{host}:{port}")
-        serve(app, host=host, port=port)
+        print(f"[server] Servindo com waitress em http://{host}:{port} ({threads} threads)")
+        serve(app, host=host, port=port, threads=threads)
     except Exception as e:
         print(f"[server] Waitress não disponível ({e}) — usando Flask dev em http://{host}:{port}")
         app.run(host=host, port=port, debug=False)
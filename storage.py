@@ -1,25 +1,203 @@
-﻿import json, os, threading
-from typing import Dict, Any
+﻿import json, os, sqlite3, threading, time
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Iterable, Sequence, Tuple
 
+# orjson (opcional) serializa o estado bem mais rápido; nos dois caminhos o formato é JSON/UTF-8 compacto
+try:
+    import orjson
+
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+    _loads = orjson.loads
+except Exception:
+    def _dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+    _loads = json.loads
+
+# db.json é o formato legado: importado uma vez para o SQLite se a tabela estiver vazia
 _DB_PATH = os.path.join(os.getcwd(), "db.json")
+_SQLITE_PATH = os.path.join(os.getcwd(), "db.sqlite3")
 _lock = threading.Lock()
+_conn: Optional[sqlite3.Connection] = None
+_local = threading.local()
+# leitura das páginas via mmap (sem cópia para o cache do SQLite); 0 desliga
+_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(64 * 1024 * 1024)))
+
+# updated_at (epoch s) marca a última atividade (gravação ou mensagem, ver touch_user):
+# base para descartar cadastros abandonados
+_UPSERT = (
+    "INSERT INTO users (uid, data, updated_at) VALUES (?, ?, CAST(strftime('%s', 'now') AS INTEGER)) "
+    "ON CONFLICT(uid) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at"
+)
+
+@contextmanager
+def _tx(conn: sqlite3.Connection):
+    """Transação explícita (a conexão fica em autocommit fora dela)."""
+    conn.execute("BEGIN")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
 
-DEFAULT = {
-    "users": {},
-}
+def _write_many(conn: sqlite3.Connection, rows) -> None:
+    with _tx(conn):
+        conn.executemany(_UPSERT, rows)
 
-def _ensure_file():
+def _migrate_json(conn: sqlite3.Connection) -> None:
     if not os.path.isfile(_DB_PATH):
-        with open(_DB_PATH, "w", encoding="utf-8") as f:
-            json.dump(DEFAULT, f, ensure_ascii=False, indent=2)
+        return
+    if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        return
+    with open(_DB_PATH, "r", encoding="utf-8") as f:
+        users = (json.load(f) or {}).get("users", {})
+    _write_many(conn, [(uid, _dumps(st)) for uid, st in users.items()])
 
-def load_db() -> Dict[str, Any]:
-    _ensure_file()
+def _connect() -> sqlite3.Connection:
+    """Conexão de escrita do processo (serializada por _lock), em autocommit + WAL."""
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(_SQLITE_PATH, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={_MMAP_BYTES}")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            "uid TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at INTEGER NOT NULL DEFAULT 0)"
+        )
+        if "updated_at" not in {r[1] for r in conn.execute("PRAGMA table_info(users)")}:
+            # bases anteriores à coluna: o prazo de inatividade conta a partir daqui
+            conn.execute("ALTER TABLE users ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0")
+            conn.execute("UPDATE users SET updated_at = ?", (int(time.time()),))
+        conn.execute("CREATE INDEX IF NOT EXISTS users_updated_at ON users (updated_at)")
+        # índice reverso hora → uid dos lembretes (gravado no commit do plano)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS schedule_fire ("
+            "hour INTEGER NOT NULL, uid TEXT NOT NULL, kind TEXT NOT NULL, "
+            "PRIMARY KEY (hour, uid, kind))"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS schedule_fire_kind ON schedule_fire (kind)")
+        conn.execute("CREATE INDEX IF NOT EXISTS schedule_fire_uid ON schedule_fire (uid)")
+        # último dia (AAAA-MM-DD) em que o cron já resolveu o check-in do uid
+        conn.execute("CREATE TABLE IF NOT EXISTS checkin_sent (uid TEXT PRIMARY KEY, day TEXT NOT NULL)")
+        _migrate_json(conn)
+        _conn = conn
+    return _conn
+
+def _reader() -> sqlite3.Connection:
+    """Conexão só-leitura por thread: no WAL leitores não esperam _lock nem uns aos outros."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        with _lock:
+            _connect()  # schema/migração prontos antes do primeiro leitor
+        conn = sqlite3.connect(_SQLITE_PATH, isolation_level=None)
+        conn.execute("PRAGMA query_only=ON")
+        conn.execute(f"PRAGMA mmap_size={_MMAP_BYTES}")
+        _local.conn = conn
+    return conn
+
+def load_user(uid: str) -> Optional[Dict[str, Any]]:
+    row = _reader().execute("SELECT data FROM users WHERE uid = ?", (uid,)).fetchone()
+    return _loads(row[0]) if row else None
+
+def load_user_seen(uid: str) -> Tuple[Optional[Dict[str, Any]], int]:
+    """Estado + updated_at (epoch s; 0 se não existe) na mesma leitura: base para chamar touch_user só se preciso."""
+    row = _reader().execute("SELECT data, updated_at FROM users WHERE uid = ?", (uid,)).fetchone()
+    return (_loads(row[0]), row[1]) if row else (None, 0)
+
+def dump_state(st: Dict[str, Any]) -> str:
+    """Serialização usada na gravação (para comparar estados sem serializar de novo)."""
+    return _dumps(st)
+
+def save_user(uid: str, st: Dict[str, Any], raw: Optional[str] = None) -> None:
+    """raw: st já serializado por dump_state (evita a 2ª serialização)."""
+    if raw is None:
+        raw = _dumps(st)
     with _lock:
-        with open(_DB_PATH, "r", encoding="utf-8") as f:
-            return json.load(f)
+        _connect().execute(_UPSERT, (uid, raw))
+
+def touch_user(uid: str, min_age_s: int = 3600) -> None:
+    """Mensagem sem mudança de estado ainda conta como atividade. Chamar só com updated_at (load_user_seen)
+    mais velho que min_age_s; o WHERE repete o teste para dois webhooks simultâneos não gravarem duas vezes."""
+    with _lock:
+        _connect().execute(
+            "UPDATE users SET updated_at = CAST(strftime('%s', 'now') AS INTEGER) "
+            "WHERE uid = ? AND updated_at < CAST(strftime('%s', 'now') AS INTEGER) - ?",
+            (uid, int(min_age_s)),
+        )
+
+def load_users(uids: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+    """Vários usuários numa consulta (lotes do cron); uid ausente fica de fora."""
+    if not uids:
+        return {}
+    marks = ",".join("?" * len(uids))
+    rows = _reader().execute(f"SELECT uid, data FROM users WHERE uid IN ({marks})", list(uids)).fetchall()
+    return {uid: _loads(raw) for uid, raw in rows}
+
+def save_users(items: Iterable[Tuple[str, Dict[str, Any]]]) -> None:
+    """Grava vários usuários numa única transação."""
+    rows = [(uid, _dumps(st)) for uid, st in items]
+    if not rows:
+        return
+    with _lock:
+        _write_many(_connect(), rows)
+
+def set_fire_slots(uid: str, slots: Iterable[Sequence[Any]]) -> None:
+    """Substitui os horários (hora, tipo) do usuário no índice do cron; [] remove."""
+    rows = [(int(h), uid, str(kind)) for h, kind in slots]
+    with _lock:
+        conn = _connect()
+        with _tx(conn):
+            conn.execute("DELETE FROM schedule_fire WHERE uid = ?", (uid,))
+            conn.execute("DELETE FROM checkin_sent WHERE uid = ?", (uid,))
+            conn.executemany("INSERT OR IGNORE INTO schedule_fire (hour, uid, kind) VALUES (?, ?, ?)", rows)
+
+def uids_for_hour(hour: int) -> List[str]:
+    """Lembretes da hora; o check-in vem de uids_checkin_due (a linha dele não entra aqui)."""
+    rows = _reader().execute(
+        "SELECT DISTINCT uid FROM schedule_fire WHERE hour = ? AND kind <> 'checkin'", (hour,)
+    ).fetchall()
+    return [r[0] for r in rows]
+
+def uids_checkin_due(day: str) -> List[str]:
+    """uids com check-in no índice que o cron ainda não resolveu em `day` (AAAA-MM-DD)."""
+    rows = _reader().execute(
+        "SELECT f.uid FROM schedule_fire f LEFT JOIN checkin_sent c ON c.uid = f.uid "
+        "WHERE f.kind = 'checkin' AND (c.day IS NULL OR c.day <> ?)",
+        (day,),
+    ).fetchall()
+    return [r[0] for r in rows]
+
+def mark_checkin_sent(uids: Iterable[str], day: str) -> None:
+    rows = [(uid, day) for uid in uids]
+    if not rows:
+        return
+    with _lock:
+        conn = _connect()
+        with _tx(conn):
+            conn.executemany(
+                "INSERT INTO checkin_sent (uid, day) VALUES (?, ?) "
+                "ON CONFLICT(uid) DO UPDATE SET day = excluded.day",
+                rows,
+            )
+
+def uids_without_slots() -> List[str]:
+    """Planos concluídos (step >= 999) sem nenhuma linha no índice — só bases anteriores a ele."""
+    rows = _reader().execute(
+        "SELECT uid FROM users WHERE uid NOT IN (SELECT uid FROM schedule_fire) "
+        "AND CAST(json_extract(data, '$.step') AS INTEGER) >= 999"
+    ).fetchall()
+    return [r[0] for r in rows]
 
-def save_db(db: Dict[str, Any]) -> None:
+def prune_stale_users(max_idle_s: int) -> int:
+    """Apaga quem não manda mensagem nem grava estado há max_idle_s e não tem lembretes no índice (cadastro abandonado)."""
     with _lock:
-        with open(_DB_PATH, "w", encoding="utf-8") as f:
-            json.dump(db, f, ensure_ascii=False, indent=2)
+        cur = _connect().execute(
+            "DELETE FROM users WHERE updated_at < CAST(strftime('%s', 'now') AS INTEGER) - ? "
+            "AND uid NOT IN (SELECT uid FROM schedule_fire)",
+            (int(max_idle_s),),
+        )
+    return cur.rowcount